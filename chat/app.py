@@ -1,5 +1,5 @@
 import asyncio
-from datetime import timedelta
+from datetime import datetime, timedelta
 import os
 import traceback
 import uuid
@@ -9,9 +9,10 @@ import grpc
 import click
 from quart import (Quart, render_template, websocket, jsonify, Response, request,
                    url_for, send_from_directory)
-from quart_rate_limiter import RateLimiter, RateLimit
+from quart_rate_limiter import RateLimiter, RateLimit, rate_exempt
 import psycopg
-from prometheus_client import generate_latest, Counter, Summary, CONTENT_TYPE_LATEST
+from prometheus_client import (generate_latest, Counter, Gauge, Summary,
+                               CONTENT_TYPE_LATEST)
 import redis
 
 import registry_pb2
@@ -19,6 +20,11 @@ import registry_pb2_grpc
 from db import get_db
 from prometheus_utils import inc_counter
 from consistent_hashing import ConsistentHashRing
+from room_routing import RoomRouter
+from spool import MessageSpool, check_message
+from search import search_messages, TTLCache
+from profiling import debug, track_task_ages
+from tracing import init_slow_request_log, span
 
 # seconds, after which the transaction is aborted
 PREPARE_PHASE_REQUEST_TIMEOUT = 3.0
@@ -26,10 +32,52 @@ PREPARE_PHASE_REQUEST_TIMEOUT = 3.0
 # number of last messages to keep in cache
 NUM_LAST_MSG_CACHED = 3
 
+# max number of search results per page
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+# number of search result pages to cache, and for how many seconds
+SEARCH_CACHE_SIZE = 256
+SEARCH_CACHE_TTL = 30.0
+
+# Write-behind mode: when set, messages are appended to this local spool file
+# and broadcast right away, and a background task writes them to the database
+MESSAGE_SPOOL_PATH = os.getenv('MESSAGE_SPOOL_PATH')
+# always, interval or never
+MESSAGE_SPOOL_FSYNC = os.getenv('MESSAGE_SPOOL_FSYNC', 'interval')
+# seconds between fsyncs for the interval policy
+MESSAGE_SPOOL_FSYNC_INTERVAL = float(os.getenv('MESSAGE_SPOOL_FSYNC_INTERVAL', 1.0))
+# seconds between drains of the spool, and max messages per drain transaction
+SPOOL_DRAIN_INTERVAL = 0.2
+SPOOL_DRAIN_BATCH_SIZE = 500
+# max seconds between drain attempts while the database fails
+SPOOL_DRAIN_MAX_BACKOFF = 10.0
+
 # Service discovery
 hostname = os.getenv('HOSTNAME', '0.0.0.0')
 service_name = os.getenv('SERVICE_NAME')
 port = int(os.getenv('PORT', 5000))
+self_address = f"{hostname}:{port}"
+
+# log the spans of requests slower than this, off when unset
+SLOW_REQUEST_THRESHOLD_MS = os.getenv('SLOW_REQUEST_THRESHOLD_MS')
+
+# Room affinity: each chatroom is owned by one chat instance,
+# picked with consistent hashing over the live instances
+# seconds between refreshes of the live instance list
+ROOM_RING_REFRESH_INTERVAL = 5.0
+# seconds after a membership change during which other instances may still
+# hold sockets for the rooms we own, so messages are also fanned out
+ROOM_RING_REBALANCE_GRACE = 2 * ROOM_RING_REFRESH_INTERVAL
+# seconds for which an instance's announcement of holding clients of a room
+# is valid, it's renewed on every refresh
+ROOM_SUBSCRIBER_TTL = 3 * ROOM_RING_REFRESH_INTERVAL
+# websocket close code telling the client to reconnect to the address
+# given as the close reason
+REDIRECT_CLOSE_CODE = 4307
+# addresses of the instances as seen by browsers, if different from
+# the registered ones, e.g. "chat-1:8008=127.0.0.1:8008,chat-2:8008=127.0.0.1:8009"
+SOCKET_ADDRESS_MAP = dict(pair.split('=', 1) for pair in
+                          os.getenv('SOCKET_ADDRESS_MAP', '').split(',') if pair)
 # TODO de-hardcode
 gateway_addr = 'http://gateway:5000'
 
@@ -44,10 +92,22 @@ rate_limiter = RateLimiter(app, default_limits=[
     RateLimit(3, timedelta(seconds=10))
 ])
 
+# /debug endpoints, enabled by QUART_DEBUG_TOKEN
+app.register_blueprint(debug)
+if SLOW_REQUEST_THRESHOLD_MS:
+    init_slow_request_log(app, float(SLOW_REQUEST_THRESHOLD_MS) / 1000)
+
 
 # Prometheus counter
 req_counter = Counter('request_count', 'Number of HTTP requests handled')
 req_time = Summary('request_latency_seconds', 'Request latency')
+search_time = Summary('search_latency_seconds', 'Message search query latency')
+search_results = Summary('search_result_count', 'Number of results per message search')
+search_cache_hits = Counter('search_cache_hits', 'Number of message searches served from cache')
+spool_depth = Gauge('message_spool_depth',
+                    'Number of spooled messages not yet written to the database')
+spool_lag = Gauge('message_spool_drain_lag_seconds',
+                  'Age of the oldest spooled message not yet written to the database')
 
 
 async def _init_db():
@@ -86,35 +146,147 @@ ring["node2"] = redis.Redis(host=os.getenv('CACHE_HOSTNAME_2'), port=6379)
 # Store connected clients by chatroom
 connected_clients = {}
 
+# Recent search result pages
+search_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+spool = None
+if MESSAGE_SPOOL_PATH:
+    spool = MessageSpool(MESSAGE_SPOOL_PATH, MESSAGE_SPOOL_FSYNC,
+                         MESSAGE_SPOOL_FSYNC_INTERVAL)
+    spool_depth.set_function(lambda: spool.depth)
+    spool_lag.set_function(lambda: spool.lag())
+
+
+# Which instance owns each chatroom
+router = RoomRouter(self_address, grace=ROOM_RING_REBALANCE_GRACE,
+                    subscriber_ttl=ROOM_SUBSCRIBER_TTL)
+
+
+def socket_address(address):
+    return SOCKET_ADDRESS_MAP.get(address, address)
+
+
+def get_registered_instances():
+    '''Query the registry for the chat instance addresses.
+    Blocking, so it's run in a thread.'''
+    with grpc.insecure_channel('service-registry:50051') as channel:
+        registry_stub = registry_pb2_grpc.ServiceRegistryStub(channel)
+        response = registry_stub.GetServiceInstances(
+            registry_pb2.ServiceQuery(service_name=service_name), timeout=2.0)
+    return {instance.address for instance in response.instances}
+
+
+async def get_members_hash(client, address):
+    '''Return the members hash of an instance, or None if it's down.'''
+    try:
+        response = await client.get(f'http://{address}/ring')
+        if response.status_code != httpx.codes.OK:
+            return None
+        return response.json()['members_hash']
+    except (httpx.HTTPError, ValueError, KeyError):
+        return None
+
+
+async def probe_instances(addresses):
+    '''Return the members hash of each live instance.'''
+    addresses = sorted(addresses)
+    async with httpx.AsyncClient(timeout=1.0) as client:
+        hashes = await asyncio.gather(*(get_members_hash(client, a) for a in addresses))
+    return {a: h for a, h in zip(addresses, hashes) if h is not None}
+
+
+async def announce_rooms(chatroom_ids):
+    '''Tell the other instances that we hold clients of these chatrooms,
+    so that their owners keep fanning out their messages to us.'''
+    if not chatroom_ids:
+        return
+    conn = await get_db()
+    async with conn.cursor() as cur:
+        for chatroom_id in chatroom_ids:
+            await cur.execute(
+                "SELECT pg_notify('room_subscribers', %s)",
+                (f"{self_address},{chatroom_id}",)
+            )
+        await conn.commit()
+
+
+async def redirect_client(client, chatroom_id):
+    await client.close(REDIRECT_CLOSE_CODE,
+                       socket_address(router.owner(chatroom_id)))
+
+
+async def refresh_room_ring():
+    while True:
+        try:
+            addresses = await asyncio.to_thread(get_registered_instances)
+        except grpc.RpcError as e:
+            print(f"RPC error: {e}")
+        else:
+            peer_hashes = await probe_instances(addresses - {self_address})
+            if router.update(peer_hashes.keys(), peer_hashes):
+                print(f"Chat instances: {sorted(router.members)}")
+
+            held = [c for c, clients in connected_clients.items() if clients]
+            try:
+                await announce_rooms(
+                    [c for c in held if not router.is_authoritative(c)])
+            except psycopg.Error as e:
+                print(f"Couldn't announce chatrooms: {e}")
+
+            # hand off the clients of the rooms we don't own
+            for chatroom_id in router.rooms_to_hand_off(held):
+                for client in list(connected_clients.get(chatroom_id, ())):
+                    await redirect_client(client, chatroom_id)
+        await asyncio.sleep(ROOM_RING_REFRESH_INTERVAL)
+
 
 async def listen_for_messages():
     conn = await get_db()
     await conn.set_autocommit(True)
     async with conn.cursor() as cur:
         await cur.execute("LISTEN messages;")
+        await cur.execute("LISTEN room_subscribers;")
 
         while True:
             # await conn.wait(notify=True)
             async for notify in conn.notifies():
+                if notify.channel == 'room_subscribers':
+                    address, chatroom_id = notify.payload.split(',', 1)
+                    router.add_remote_subscriber(chatroom_id, address)
+                    continue
+
                 # Broadcast to clients in the relevant chatroom
                 # Extract chatroom_id from the payload
-                chatroom_id, message = notify.payload.split(',', 1)
+                origin, chatroom_id, message = notify.payload.split(',', 2)
+                # the origin has already broadcast it to its own clients
+                if origin == hostname:
+                    continue
                 await broadcast_to_clients(chatroom_id, message)
 
 
 async def broadcast_to_clients(chatroom_id, message):
     if chatroom_id in connected_clients:
-        for client in connected_clients[chatroom_id]:
+        for client in list(connected_clients[chatroom_id]):
             await client.send(message)
 
 
+async def notify_message(cur, chatroom_id, content):
+    '''Fan the message out to the other instances, if they may need it.'''
+    if router.needs_fanout(chatroom_id):
+        await cur.execute(
+            "SELECT pg_notify('messages', %s)",
+            (f"{hostname},{chatroom_id},{content}",)
+        )
+
+
 # Add a new message
 def cache_message(chat_id, content):
     r = ring[str(chat_id)]
-    redis_host = r.connection_pool.get_connection('PING').host
-    print(f"Cached on: {redis_host}")
-    r.lpush(chat_id, content)  # Add the message to the list
-    r.ltrim(chat_id, 0, NUM_LAST_MSG_CACHED-1)
+    with span('redis'):
+        redis_host = r.connection_pool.get_connection('PING').host
+        print(f"Cached on: {redis_host}")
+        r.lpush(chat_id, content)  # Add the message to the list
+        r.ltrim(chat_id, 0, NUM_LAST_MSG_CACHED-1)
 
 
 async def insert_message(chatroom_id, user_id, content):
@@ -127,18 +299,103 @@ async def insert_message(chatroom_id, user_id, content):
             (chatroom_id, user_id, content)
         )
 
-        await cur.execute(
-            f"NOTIFY messages, '{chatroom_id},{content}'"
-        )
+        await notify_message(cur, chatroom_id, content)
 
         await conn.commit()
 
+    await broadcast_to_clients(chatroom_id, content)
+
+
+def cache_messages(messages):
+    '''Cache several (chat_id, content) messages,
+    with one round trip per cache node.'''
+    pipelines = {}
+    for chat_id, content in messages:
+        r = ring[str(chat_id)]
+        if id(r) not in pipelines:
+            pipelines[id(r)] = r.pipeline(transaction=False)
+        pipelines[id(r)].lpush(chat_id, content)
+        pipelines[id(r)].ltrim(chat_id, 0, NUM_LAST_MSG_CACHED-1)
+    for pipeline in pipelines.values():
+        pipeline.execute()
+
+
+async def spool_message(chatroom_id, user_id, content):
+    '''Write-behind version of insert_message: append to the spool
+    and broadcast locally, drain_spool writes it to the database
+    and the cache. Raise ValueError if the database would reject it.'''
+    check_message(chatroom_id, user_id, content, f"{hostname},{chatroom_id},")
+    await spool.append(chatroom_id, user_id, content)
+    await broadcast_to_clients(chatroom_id, content)
+
+
+async def flush_spool():
+    '''Write the oldest batch of spooled messages to the database.
+    Return the number of messages written.'''
+    entries = spool.pending(SPOOL_DRAIN_BATCH_SIZE)
+    if not entries:
+        return 0
+
+    conn = await get_db()
+    async with conn.cursor() as cur:
+        # a replay after a crash may contain already inserted messages
+        await cur.executemany(
+            'INSERT INTO messages (chatroom_id, user_id, content, timestamp, origin, origin_seq) '
+            'VALUES (%s, %s, %s, to_timestamp(%s), %s, %s) '
+            'ON CONFLICT (origin, origin_seq) DO NOTHING',
+            [(e['chatroom_id'], e['user_id'], e['content'], e['ts'], spool.epoch, e['seq'])
+             for e in entries]
+        )
+        for e in entries:
+            await notify_message(cur, e['chatroom_id'], e['content'])
+        await conn.commit()
+
+    await spool.mark_flushed(entries[-1]['seq'])
+
+    # the cache is updated off the event loop, and only best effort
+    try:
+        await asyncio.to_thread(
+            cache_messages, [(e['chatroom_id'], e['content']) for e in entries])
+    except redis.RedisError as e:
+        print(f"Couldn't cache spooled messages: {e}")
+    return len(entries)
+
+
+async def sync_spool():
+    '''fsync the spool for the interval policy, even when no new
+    messages arrive to trigger it.'''
+    while True:
+        await asyncio.sleep(min(SPOOL_DRAIN_INTERVAL, MESSAGE_SPOOL_FSYNC_INTERVAL))
+        await spool.sync_if_due()
+
+
+async def drain_spool():
+    delay = SPOOL_DRAIN_INTERVAL
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            # keep going while there is a backlog
+            while await flush_spool() == SPOOL_DRAIN_BATCH_SIZE:
+                pass
+            delay = SPOOL_DRAIN_INTERVAL
+        except (psycopg.Error, OSError) as e:
+            # the messages stay in the spool and are retried,
+            # backing off while the database is unavailable
+            print(f"Couldn't drain message spool: {e}")
+            delay = min(delay * 2, SPOOL_DRAIN_MAX_BACKOFF)
+            try:
+                conn = await get_db()
+                await conn.rollback()
+            except (psycopg.Error, OSError) as e:
+                print(f"Couldn't roll back: {e}")
+
 
 # Get the last 5 messages
 def get_messages(chat_id):
     '''Retrieve last cached messages as a list'''
     r = ring[str(chat_id)]
-    bl = r.lrange(chat_id, 0, -1)
+    with span('redis'):
+        bl = r.lrange(chat_id, 0, -1)
     sl = [b.decode() for b in bl]
     return sl[::-1]
 
@@ -146,8 +403,9 @@ def get_messages(chat_id):
 async def get_users_list():
     conn = await get_db()
     async with conn.cursor() as cur:
-        await cur.execute('SELECT username FROM users')
-        rows = await cur.fetchall()
+        with span('db'):
+            await cur.execute('SELECT username FROM users')
+            rows = await cur.fetchall()
     return [row[0] for row in rows]
 
 
@@ -162,10 +420,53 @@ async def index(chat_id):
                                  users=await get_users_list())
 
 
+@app.get("/chat/<chat_id>/search")
+@inc_counter(req_counter)
+@req_time.time()
+async def search_view(chat_id):
+    '''Full-text search of a chatroom's messages, newest first.
+    Takes q, optional since and until ISO timestamps, limit,
+    and the cursor returned with the previous page.'''
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({"error": "Missing query"}), 400
+    try:
+        since = request.args.get('since')
+        since = datetime.fromisoformat(since) if since else None
+        until = request.args.get('until')
+        until = datetime.fromisoformat(until) if until else None
+        limit = int(request.args.get('limit', SEARCH_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "Invalid parameters"}), 400
+    limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+    cursor = request.args.get('cursor')
+
+    key = (chat_id, q, since, until, cursor, limit)
+    page = search_cache.get(key)
+    if page is not None:
+        search_cache_hits.inc()
+        return jsonify(page)
+
+    conn = await get_db()
+    try:
+        with search_time.time(), span('db'):
+            async with conn.cursor() as cur:
+                results, next_cursor = await search_messages(
+                    cur, chat_id, q, since, until, cursor, limit)
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+    search_results.observe(len(results))
+
+    page = {"results": results, "next_cursor": next_cursor}
+    search_cache.set(key, page)
+    return jsonify(page)
+
+
 async def verify_user(username, password):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f'{gateway_addr}/users/login',
-                                     json={'username': username, 'password': password})
+    with span('http'):
+        async with httpx.AsyncClient() as client:
+            response = await client.post(f'{gateway_addr}/users/login',
+                                         json={'username': username, 'password': password})
     if response.status_code != httpx.codes.OK:
         return False
 
@@ -176,10 +477,11 @@ async def register_user(username):
     conn = await get_db()
     async with conn.cursor() as cur:
         try:
-            await cur.execute(
-                'INSERT INTO users (username) VALUES (%s)', (username,)
-            )
-            await conn.commit()
+            with span('db'):
+                await cur.execute(
+                    'INSERT INTO users (username) VALUES (%s)', (username,)
+                )
+                await conn.commit()
 
         except psycopg.errors.UniqueViolation:
             raise ValueError("Username exists")
@@ -189,10 +491,11 @@ async def delete_user(username):
     conn = await get_db()
     async with conn.cursor() as cur:
         try:
-            await cur.execute(
-                "DELETE FROM users WHERE username = %s", (username,)
-            )
-            await conn.commit()
+            with span('db'):
+                await cur.execute(
+                    "DELETE FROM users WHERE username = %s", (username,)
+                )
+                await conn.commit()
 
         except psycopg.errors.UniqueViolation:
             raise ValueError("Couldn't delete user")
@@ -237,6 +540,13 @@ async def view_sleep(duration):
 
 @app.websocket('/socket/chat/<chatroom_id>')
 async def chat(chatroom_id):
+    # Send the client to the owner of the room, unless it was already
+    # redirected, in which case the owners disagree during a rebalancing
+    if router.should_redirect(chatroom_id, websocket.args.get('redirected')):
+        await websocket.accept()
+        await redirect_client(websocket, chatroom_id)
+        return
+
     # Register the new client
     if chatroom_id not in connected_clients:
         connected_clients[chatroom_id] = set()
@@ -246,12 +556,24 @@ async def chat(chatroom_id):
     connected_clients[chatroom_id].add(client)
 
     try:
+        # unless we're sure we own the room, make sure its owner
+        # fans out its messages to us
+        if not router.is_authoritative(chatroom_id):
+            await announce_rooms([chatroom_id])
+
         while True:
             # Handle incoming messages (if needed)
             data = await websocket.receive()
             # Optionally process incoming messages here
             # Example: Insert new messages into the database
-            await insert_message(chatroom_id, "sender_id_placeholder", data)
+            if spool is not None:
+                try:
+                    await spool_message(chatroom_id, "sender_id_placeholder", data)
+                except ValueError as e:
+                    # it would block the spool, as the database would reject it
+                    print(f"Rejected message: {e}")
+            else:
+                await insert_message(chatroom_id, "sender_id_placeholder", data)
 
     except Exception as e:
         print(f"Client disconnected: {e}")
@@ -294,6 +616,14 @@ async def status_view():
     return jsonify({"status": "Alive"})
 
 
+@app.route('/ring')
+@rate_exempt
+async def ring_view():
+    '''Probed by the other chat instances, to check that we're alive
+    and see the same instances as them. Not counted in the metrics.'''
+    return jsonify({"members_hash": router.members_hash})
+
+
 def task_done_callback(task):
     try:
         task.result()  # This will raise any exceptions that happened in the task
@@ -303,6 +633,11 @@ def task_done_callback(task):
         traceback.print_exc()
 
 
+@app.before_serving
+async def startup_task_tracking():
+    track_task_ages(asyncio.get_running_loop())
+
+
 @app.before_serving
 async def startup_RPC_task():
     loop = asyncio.get_event_loop()
@@ -324,8 +659,42 @@ async def startup_messages_listen():
     app.listen_task.add_done_callback(task_done_callback)
 
 
+@app.before_serving
+async def startup_room_ring_refresh():
+    loop = asyncio.get_event_loop()
+    app.ring_task = loop.create_task(refresh_room_ring())
+    app.ring_task.add_done_callback(task_done_callback)
+
+
+@app.after_serving
+async def shutdown_room_ring_refresh():
+    app.ring_task.cancel()
+
+
 @app.before_serving
 async def startup():
     # either init db from here,
     # or for persistency call this func from CLI
     await _init_db()
+
+
+@app.before_serving
+async def startup_spool_drain():
+    # registered after startup, so that the spool is replayed into
+    # the tables _init_db recreates and not into the dropped ones
+    if spool is None:
+        return
+    loop = asyncio.get_event_loop()
+    app.drain_task = loop.create_task(drain_spool())
+    app.drain_task.add_done_callback(task_done_callback)
+    app.sync_task = loop.create_task(sync_spool())
+    app.sync_task.add_done_callback(task_done_callback)
+
+
+@app.after_serving
+async def shutdown_spool_drain():
+    if spool is None:
+        return
+    app.drain_task.cancel()
+    app.sync_task.cancel()
+    spool.close()
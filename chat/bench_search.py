@@ -0,0 +1,129 @@
+'''Benchmark message search over a synthetic corpus.
+
+Fills a copy of the messages table, with the same columns and indexes,
+with random messages, then times random searches the same way
+the /chat/<id>/search view runs them. The copy is dropped at the end,
+unless --keep is given. Run it inside a chat container of a development
+setup, so that it uses the same database:
+
+    python bench_search.py --messages 2000000 --rooms 1000
+'''
+import argparse
+import asyncio
+import itertools
+import random
+import statistics
+import time
+
+from db import get_db
+from search import search_messages
+
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'tu', 'ne', 'si', 'po', 'de', 'fa']
+
+# a vocabulary of pronounceable words, so that to_tsvector keeps them as words
+WORDS = [''.join(p) for n in (2, 3) for p in itertools.product(SYLLABLES, repeat=n)]
+
+# messages inserted per statement
+INSERT_BATCH_SIZE = 100000
+
+# the synthetic corpus is kept apart from the real messages
+BENCH_TABLE = 'bench_search_messages'
+
+# the random() ** 3 skews word frequencies, like in real text
+INSERT_QUERY = '''
+INSERT INTO {table} (id, chatroom_id, user_id, content, timestamp)
+SELECT %(first_id)s + g,
+       'bench-' || floor(random() * %(rooms)s)::int,
+       'user' || floor(random() * 1000)::int,
+       array_to_string(ARRAY(
+           SELECT (%(words)s::text[])[1 + floor(%(n_words)s * random() ^ 3)::int]
+           FROM generate_series(1, 5 + g %% 10)
+       ), ' '),
+       now() - random() * interval '365 days'
+FROM generate_series(1, %(count)s) g
+'''
+
+
+async def fill(cur, conn, n_messages, n_rooms):
+    # the copy gets no defaults, so that it doesn't use the id sequence of messages
+    await cur.execute(f'DROP TABLE IF EXISTS {BENCH_TABLE}')
+    await cur.execute(
+        f'CREATE TABLE {BENCH_TABLE} (LIKE messages INCLUDING ALL EXCLUDING DEFAULTS)')
+    await conn.commit()
+
+    start = time.perf_counter()
+    for done in range(0, n_messages, INSERT_BATCH_SIZE):
+        count = min(INSERT_BATCH_SIZE, n_messages - done)
+        await cur.execute(INSERT_QUERY.format(table=BENCH_TABLE), {
+            'first_id': done, 'rooms': n_rooms, 'words': WORDS,
+            'n_words': len(WORDS), 'count': count})
+        await conn.commit()
+        print(f"Inserted {done + count}/{n_messages} messages")
+    print(f"Filled in {time.perf_counter() - start:.1f}s")
+
+    await cur.execute(f'ANALYZE {BENCH_TABLE}')
+    await conn.commit()
+
+
+def random_query():
+    # mostly popular words, sometimes a rare one or a phrase
+    words = random.choices(WORDS[:50], k=random.randint(1, 2))
+    if random.random() < 0.2:
+        words = [random.choice(WORDS)]
+    if random.random() < 0.1:
+        return '"' + ' '.join(words) + '"'
+    return ' '.join(words)
+
+
+async def bench(cur, n_rooms, n_queries, pages):
+    latencies = []
+    counts = []
+    for _ in range(n_queries):
+        room = f'bench-{random.randrange(n_rooms)}'
+        q = random_query()
+        cursor = None
+        for _ in range(pages):
+            start = time.perf_counter()
+            results, cursor = await search_messages(cur, room, q, cursor=cursor,
+                                                    table=BENCH_TABLE)
+            latencies.append(time.perf_counter() - start)
+            counts.append(len(results))
+            if cursor is None:
+                break
+
+    latencies.sort()
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"{len(latencies)} searches, {statistics.mean(counts):.1f} results on average")
+    print(f"latency p50: {quantiles[49] * 1000:.2f}ms, "
+          f"p95: {quantiles[94] * 1000:.2f}ms, "
+          f"p99: {quantiles[98] * 1000:.2f}ms, "
+          f"max: {latencies[-1] * 1000:.2f}ms")
+
+
+async def main(args):
+    conn = await get_db()
+    async with conn.cursor() as cur:
+        try:
+            if not args.skip_fill:
+                await fill(cur, conn, args.messages, args.rooms)
+            await bench(cur, args.rooms, args.queries, args.pages)
+        finally:
+            await conn.rollback()
+            if not args.keep:
+                await cur.execute(f'DROP TABLE IF EXISTS {BENCH_TABLE}')
+                await conn.commit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000000)
+    parser.add_argument('--rooms', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--pages', type=int, default=3,
+                        help='number of result pages to fetch per query')
+    parser.add_argument('--skip-fill', action='store_true',
+                        help='reuse the messages of a previous run with --keep')
+    parser.add_argument('--keep', action='store_true',
+                        help=f'keep the {BENCH_TABLE} table for later runs')
+    asyncio.run(main(parser.parse_args()))
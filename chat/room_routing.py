@@ -0,0 +1,117 @@
+from hashlib import md5
+import time
+
+from consistent_hashing import ConsistentHashRing
+
+
+class RoomRouter(object):
+    """Decide which chat instance owns each chatroom.
+
+    Rooms are spread over the live instances with consistent hashing.
+    Instances can briefly disagree on which ones are live, so an instance
+    only skips fanning out a room's messages to the others when it owns
+    the room, every live instance has the same member list, and no other
+    instance announced holding clients of the room.
+    """
+
+    def __init__(self, self_address, replicas=100, grace=10.0, subscriber_ttl=15.0):
+        """Create a router for the instance at self_address.
+
+        grace is how long after a membership change messages are still
+        fanned out, and subscriber_ttl how long an announcement
+        of remote clients is valid.
+        """
+        self.self_address = self_address
+        self.replicas = replicas
+        self.grace = grace
+        self.subscriber_ttl = subscriber_ttl
+        self._ring = None
+        self.members = frozenset()
+        self.members_hash = ''
+        self.agreed = False
+        self._changed_at = 0.0
+        # chatroom_id -> {address: expiry}
+        self._remote_subscribers = {}
+
+    @staticmethod
+    def hash_members(members):
+        return md5(','.join(sorted(members)).encode()).hexdigest()
+
+    def update(self, members, peer_hashes, now=None):
+        """Set the live members (including this instance), given the
+        members hash reported by each of the other live instances.
+        Return whether the member list changed."""
+        now = time.monotonic() if now is None else now
+        members = frozenset(members) | {self.self_address}
+        changed = members != self.members
+        if changed:
+            ring = ConsistentHashRing(self.replicas)
+            for address in members:
+                ring[address] = address
+            self._ring = ring
+            self.members = members
+            self.members_hash = self.hash_members(members)
+            self._changed_at = now
+
+        agreed = all(peer_hashes.get(address) == self.members_hash
+                     for address in members - {self.self_address})
+        if agreed and not self.agreed:
+            # the clients placed under the old views still have to move
+            self._changed_at = now
+        self.agreed = agreed
+        return changed
+
+    def owner(self, chatroom_id):
+        """Return the address of the instance that owns the chatroom."""
+        if self._ring is None:
+            return self.self_address
+        return self._ring[str(chatroom_id)]
+
+    def is_owner(self, chatroom_id):
+        return self.owner(chatroom_id) == self.self_address
+
+    def is_authoritative(self, chatroom_id):
+        """Whether all instances agree that this one owns the chatroom."""
+        return self._ring is not None and self.agreed and self.is_owner(chatroom_id)
+
+    def should_redirect(self, chatroom_id, redirected):
+        """Whether a new client of the chatroom should go to its owner.
+        A client which was already redirected stays, to avoid loops while
+        instances disagree, and is announced instead."""
+        return not redirected and not self.is_owner(chatroom_id)
+
+    def rooms_to_hand_off(self, chatroom_ids):
+        """Return the chatrooms whose clients should move to their owner.
+        Clients only move once the instances agree, so they don't bounce."""
+        if not self.agreed:
+            return []
+        return [c for c in chatroom_ids if not self.is_owner(c)]
+
+    def add_remote_subscriber(self, chatroom_id, address, now=None):
+        """Record that another instance holds clients of the chatroom."""
+        if address == self.self_address:
+            return
+        now = time.monotonic() if now is None else now
+        self._remote_subscribers.setdefault(chatroom_id, {})[address] = \
+            now + self.subscriber_ttl
+
+    def has_remote_subscribers(self, chatroom_id, now=None):
+        subscribers = self._remote_subscribers.get(chatroom_id)
+        if not subscribers:
+            return False
+        now = time.monotonic() if now is None else now
+        for address, expiry in list(subscribers.items()):
+            if expiry < now:
+                del subscribers[address]
+        if not subscribers:
+            del self._remote_subscribers[chatroom_id]
+            return False
+        return True
+
+    def needs_fanout(self, chatroom_id, now=None):
+        """Whether other instances may hold clients of the chatroom,
+        so that its messages must be broadcast through the database."""
+        now = time.monotonic() if now is None else now
+        return (not self.is_authoritative(chatroom_id)
+                or now - self._changed_at < self.grace
+                or self.has_remote_subscribers(chatroom_id, now))
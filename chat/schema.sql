@@ -1,5 +1,8 @@
 DROP TABLE IF EXISTS users, messages;
 
+-- lets the search index also cover chatroom_id
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
 
 CREATE TABLE users (
     id SERIAL PRIMARY KEY,
@@ -12,5 +15,16 @@ CREATE TABLE messages (
     chatroom_id VARCHAR(255) NOT NULL,  
     user_id VARCHAR(255) NOT NULL,
     content TEXT NOT NULL,
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    -- spool epoch and sequence number of messages written from a spool,
+    -- so that replays are idempotent
+    origin VARCHAR(255),
+    origin_seq BIGINT,
+    content_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', content)) STORED,
+    UNIQUE (origin, origin_seq)
 );
+
+-- full-text search within a chatroom
+CREATE INDEX messages_search_idx ON messages USING GIN (chatroom_id, content_tsv);
+-- newest-first pagination within a chatroom
+CREATE INDEX messages_chatroom_time_idx ON messages (chatroom_id, timestamp DESC, id DESC);
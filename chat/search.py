@@ -0,0 +1,100 @@
+from collections import OrderedDict
+from datetime import datetime
+import base64
+import time
+
+
+SEARCH_QUERY = '''
+SELECT id, user_id, content, timestamp FROM {table}
+WHERE {conditions}
+ORDER BY timestamp DESC, id DESC
+LIMIT %s
+'''
+
+
+def encode_cursor(timestamp, id):
+    """Encode the position of the last returned message as an opaque string."""
+    raw = f"{timestamp.isoformat()}|{id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return the (timestamp, id) encoded in the cursor.
+    Raise ValueError if it's malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(id)
+    except (ValueError, UnicodeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+async def search_messages(cur, chatroom_id, q, since=None, until=None,
+                          cursor=None, limit=20, table='messages'):
+    """Search the messages of a chatroom, newest first.
+    table is a trusted name of a table shaped like messages.
+
+    Return the page of results and the cursor of the next page,
+    which is None on the last page.
+    """
+    # only the filters in use go into the query, so the planner
+    # can pick the right index for each combination
+    conditions = ["chatroom_id = %s",
+                  "content_tsv @@ websearch_to_tsquery('english', %s)"]
+    params = [chatroom_id, q]
+    if since is not None:
+        conditions.append("timestamp >= %s")
+        params.append(since)
+    if until is not None:
+        conditions.append("timestamp < %s")
+        params.append(until)
+    if cursor:
+        conditions.append("(timestamp, id) < (%s, %s)")
+        params.extend(decode_cursor(cursor))
+    # fetch one more row to know whether there is a next page
+    params.append(limit + 1)
+
+    await cur.execute(
+        SEARCH_QUERY.format(table=table, conditions=' AND '.join(conditions)),
+        params)
+    rows = await cur.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][3], rows[-1][0])
+
+    results = [{'id': id, 'user_id': user_id, 'content': content,
+                'timestamp': timestamp.isoformat()}
+               for id, user_id, content, timestamp in rows]
+    return results, next_cursor
+
+
+class TTLCache(object):
+    """A small LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, maxsize=256, ttl=30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        """Return the cached value, or None if missing or expired."""
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,185 @@
+import asyncio
+from collections import deque
+import json
+import os
+import time
+import uuid
+
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+# limits of the messages table and of pg_notify, which a spooled message
+# must fit in, or it would fail every attempt to drain it
+MAX_CHATROOM_ID_LENGTH = 255
+MAX_USER_ID_LENGTH = 255
+MAX_NOTIFY_PAYLOAD_BYTES = 7999
+
+
+def check_message(chatroom_id, user_id, content, notify_prefix=''):
+    """Raise ValueError if the message can't be written to the database.
+    notify_prefix is what precedes the content in its NOTIFY payload."""
+    if not isinstance(content, str):
+        raise ValueError("Message isn't text")
+    if len(chatroom_id) > MAX_CHATROOM_ID_LENGTH:
+        raise ValueError("Chatroom id too long")
+    if len(user_id) > MAX_USER_ID_LENGTH:
+        raise ValueError("User id too long")
+    # Postgres text can't hold NUL
+    if '\x00' in chatroom_id or '\x00' in user_id or '\x00' in content:
+        raise ValueError("Message contains NUL")
+    if len((notify_prefix + content).encode()) > MAX_NOTIFY_PAYLOAD_BYTES:
+        raise ValueError("Message too long")
+
+
+class MessageSpool(object):
+    """Local append-only spool of messages not yet written to the database.
+
+    Every message is appended as a JSON line with an increasing sequence
+    number. The sequence number of the last message written to the database
+    is kept in a separate checkpoint file, so after a crash the spool can
+    be reopened and the messages after the checkpoint replayed.
+
+    The checkpoint also holds the spool's epoch, a random id made when the
+    spool is created. Together with the sequence number it identifies
+    a message, even if the spool is lost and starts over from 1.
+    """
+
+    def __init__(self, path, fsync_policy='interval', fsync_interval=1.0):
+        """Open the spool at the given path, replaying unflushed messages.
+
+        fsync_policy is one of:
+        - always: fsync before append returns
+        - interval: fsync at most fsync_interval seconds after an append,
+          as long as sync_if_due is called regularly
+        - never: leave it to the OS
+        """
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy %r" % fsync_policy)
+        self.path = path
+        self.checkpoint_path = path + '.checkpoint'
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self._last_fsync = time.monotonic()
+        self._sync_lock = asyncio.Lock()
+        self._pending = deque()
+        self.epoch, self._flushed_seq = self._read_checkpoint()
+        self._next_seq = self._flushed_seq + 1
+        self._replay()
+        self._file = open(self.path, 'a', encoding='utf-8')
+        # everything replayed from the file is already on disk
+        self.synced_seq = self._next_seq - 1
+
+    def _read_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, encoding='utf-8') as file:
+                checkpoint = json.load(file)
+            return checkpoint['epoch'], checkpoint['seq']
+        except FileNotFoundError:
+            # a new spool, the epoch must be on disk before any message is
+            epoch = str(uuid.uuid4())
+            self._write_checkpoint(epoch, 0)
+            return epoch, 0
+
+    def _write_checkpoint(self, epoch, seq):
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({'epoch': epoch, 'seq': seq}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _replay(self):
+        """Load the messages after the checkpoint into the pending queue."""
+        try:
+            file = open(self.path, 'rb+')
+        except FileNotFoundError:
+            return
+        with file:
+            valid_end = 0
+            for line in file:
+                # a torn write from a crash can only be the last line
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                valid_end += len(line)
+                self._next_seq = max(self._next_seq, entry['seq'] + 1)
+                if entry['seq'] > self._flushed_seq:
+                    self._pending.append(entry)
+            # drop the torn line, so that new appends start on a fresh line
+            file.truncate(valid_end)
+
+    async def sync(self):
+        """fsync the spool file in a thread, so the event loop keeps running.
+        Concurrent callers share a single fsync (group commit)."""
+        seq = self._next_seq - 1
+        async with self._sync_lock:
+            if self.synced_seq >= seq:
+                return
+            target = self._next_seq - 1
+            self._last_fsync = time.monotonic()
+            await asyncio.to_thread(os.fsync, self._file.fileno())
+            self.synced_seq = max(self.synced_seq, target)
+
+    async def sync_if_due(self):
+        """For the interval policy, fsync if the interval has passed
+        since the last fsync and there are unsynced messages."""
+        if (self.fsync_policy == 'interval'
+                and self.synced_seq < self._next_seq - 1
+                and time.monotonic() - self._last_fsync >= self.fsync_interval):
+            await self.sync()
+
+    async def append(self, chatroom_id, user_id, content):
+        """Durably (per the fsync policy) append a message and return it."""
+        entry = {
+            'seq': self._next_seq,
+            'ts': time.time(),
+            'chatroom_id': chatroom_id,
+            'user_id': user_id,
+            'content': content,
+        }
+        self._next_seq += 1
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        self._pending.append(entry)
+        if self.fsync_policy == 'always':
+            await self.sync()
+        return entry
+
+    def pending(self, limit=None):
+        """Return up to limit of the oldest unflushed messages."""
+        if limit is None:
+            return list(self._pending)
+        return [self._pending[i] for i in range(min(limit, len(self._pending)))]
+
+    async def mark_flushed(self, seq):
+        """Record that every message up to seq is in the database."""
+        while self._pending and self._pending[0]['seq'] <= seq:
+            self._pending.popleft()
+        self._flushed_seq = max(self._flushed_seq, seq)
+
+        await asyncio.to_thread(self._write_checkpoint, self.epoch, self._flushed_seq)
+
+        # once everything is flushed the spool file can start over,
+        # the checkpoint keeps the sequence numbers increasing
+        if not self._pending:
+            self._file.truncate(0)
+
+    @property
+    def depth(self):
+        """Number of messages waiting to be written to the database."""
+        return len(self._pending)
+
+    def lag(self):
+        """Age in seconds of the oldest unflushed message."""
+        if not self._pending:
+            return 0.0
+        return max(0.0, time.time() - self._pending[0]['ts'])
+
+    def close(self):
+        self._file.flush()
+        if self.fsync_policy != 'never':
+            os.fsync(self._file.fileno())
+        self._file.close()
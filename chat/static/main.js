@@ -1,7 +1,11 @@
 
 let ws;
 
-function connect() {
+// Close code sent by a chat instance which doesn't own the chatroom,
+// the reason is the address of the owner
+const REDIRECT_CLOSE_CODE = 4307;
+
+function connect(address, redirected) {
     if (typeof socket_port == "undefined") {
         console.log("socket_port is not set.");
         return;
@@ -11,7 +15,10 @@ function connect() {
     if (ws) {
         ws.close(); // Close existing connection if present
     }
-    const socket_url = `ws://127.0.0.1:${socket_port}/socket/chat/${chatroom}`;
+    let socket_url = `ws://${address || `127.0.0.1:${socket_port}`}/socket/chat/${chatroom}`;
+    if (redirected) {
+        socket_url += '?redirected=1';
+    }
     console.log(socket_url);
     ws = new WebSocket(socket_url);
 
@@ -25,7 +32,13 @@ function connect() {
         console.log(`Connected to chatroom: ${chatroom}`);
     });
 
-    ws.addEventListener('close', function () {
+    ws.addEventListener('close', function (event) {
+        if (event.code === REDIRECT_CLOSE_CODE) {
+            console.log(`Chatroom ${chatroom} is served by ${event.reason}`);
+            ws = null;
+            connect(event.reason, true);
+            return;
+        }
         console.log(`Disconnected from chatroom: ${chatroom}`);
     });
 
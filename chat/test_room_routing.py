@@ -0,0 +1,107 @@
+from room_routing import RoomRouter
+
+import unittest
+
+
+A = 'chat-1:8008'
+B = 'chat-2:8008'
+ROOMS = ['room%d' % i for i in range(100)]
+
+
+def make_router(address, members, peer_hashes=None, now=0.0):
+    router = RoomRouter(address, grace=10.0, subscriber_ttl=15.0)
+    if peer_hashes is None:
+        # every peer sees the same members
+        peer_hashes = {m: RoomRouter.hash_members(members) for m in members}
+    router.update(set(members) - {address}, peer_hashes, now=now)
+    return router
+
+
+class RoomRouterTest(unittest.TestCase):
+    def test_owns_everything_before_update(self):
+        router = RoomRouter(A)
+        self.assertTrue(all(router.is_owner(room) for room in ROOMS))
+        self.assertFalse(router.should_redirect('room1', redirected=False))
+        # but doesn't know whether other instances hold clients
+        self.assertTrue(router.needs_fanout('room1'))
+
+    def test_owners_agree(self):
+        a = make_router(A, {A, B})
+        b = make_router(B, {A, B})
+        self.assertTrue(a.agreed and b.agreed)
+        for room in ROOMS:
+            self.assertEqual(a.owner(room), b.owner(room))
+        owned_by_a = [room for room in ROOMS if a.is_owner(room)]
+        self.assertTrue(0 < len(owned_by_a) < len(ROOMS))
+
+    def test_fanout_after_grace(self):
+        a = make_router(A, {A, B})
+        room = next(room for room in ROOMS if a.is_owner(room))
+        other = next(room for room in ROOMS if not a.is_owner(room))
+
+        self.assertTrue(a.needs_fanout(room, now=5.0))
+        self.assertFalse(a.needs_fanout(room, now=11.0))
+        # the sender of a room we don't own always fans out
+        self.assertTrue(a.needs_fanout(other, now=11.0))
+
+    def test_disagreeing_views_fan_out(self):
+        # A lost its probe of B, while B sees both
+        a = make_router(A, {A}, peer_hashes={})
+        b = make_router(B, {A, B}, peer_hashes={A: RoomRouter.hash_members({A})})
+        self.assertTrue(a.agreed)
+        self.assertFalse(b.agreed)
+
+        # a room both think they own
+        room = next(room for room in ROOMS if b.is_owner(room))
+        self.assertTrue(a.is_owner(room))
+        self.assertFalse(b.is_authoritative(room))
+        self.assertTrue(b.needs_fanout(room, now=100.0))
+
+        # B announces its clients, so A fans out too
+        self.assertFalse(a.needs_fanout(room, now=100.0))
+        a.add_remote_subscriber(room, B, now=100.0)
+        self.assertTrue(a.needs_fanout(room, now=101.0))
+
+    def test_remote_subscribers_expire(self):
+        a = make_router(A, {A, B})
+        room = next(room for room in ROOMS if a.is_owner(room))
+        a.add_remote_subscriber(room, B, now=20.0)
+        self.assertTrue(a.needs_fanout(room, now=30.0))
+        self.assertFalse(a.needs_fanout(room, now=40.0))
+
+        # our own announcements don't count
+        a.add_remote_subscriber(room, A, now=40.0)
+        self.assertFalse(a.needs_fanout(room, now=41.0))
+
+    def test_redirect(self):
+        a = make_router(A, {A, B})
+        other = next(room for room in ROOMS if not a.is_owner(room))
+        self.assertEqual(a.owner(other), B)
+        self.assertTrue(a.should_redirect(other, redirected=False))
+        # a redirected client is kept, and announced instead
+        self.assertFalse(a.should_redirect(other, redirected='1'))
+        self.assertFalse(a.is_authoritative(other))
+
+    def test_hand_off_only_when_agreed(self):
+        a = make_router(A, {A, B}, peer_hashes={B: RoomRouter.hash_members({B})})
+        self.assertFalse(a.agreed)
+        self.assertEqual(a.rooms_to_hand_off(ROOMS), [])
+
+        a.update({B}, {B: a.members_hash}, now=1.0)
+        self.assertTrue(a.agreed)
+        self.assertEqual(a.rooms_to_hand_off(ROOMS),
+                         [room for room in ROOMS if a.owner(room) == B])
+        # reaching agreement restarts the grace period
+        room = next(room for room in ROOMS if a.is_owner(room))
+        self.assertTrue(a.needs_fanout(room, now=5.0))
+
+    def test_update_reports_changes(self):
+        a = RoomRouter(A)
+        self.assertTrue(a.update({B}, {}, now=0.0))
+        self.assertFalse(a.update({B}, {}, now=1.0))
+        self.assertTrue(a.update(set(), {}, now=2.0))
+        self.assertEqual(a.members, {A})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+from search import encode_cursor, decode_cursor, TTLCache
+
+from datetime import datetime
+import time
+import unittest
+
+
+class CursorTest(unittest.TestCase):
+    def test_roundtrip(self):
+        timestamp = datetime(2024, 11, 5, 12, 30, 15, 123456)
+        cursor = encode_cursor(timestamp, 42)
+        self.assertEqual(decode_cursor(cursor), (timestamp, 42))
+
+    def test_invalid(self):
+        for cursor in ['', 'not a cursor', encode_cursor(datetime.now(), 1)[:-4]]:
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+
+class TTLCacheTest(unittest.TestCase):
+    def test_get_set(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expires(self):
+        cache = TTLCache(maxsize=2, ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
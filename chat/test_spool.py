@@ -0,0 +1,135 @@
+from spool import MessageSpool, check_message
+
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+
+class MessageSpoolTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'messages.spool')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def test_append_and_flush(self):
+        spool = MessageSpool(self.path, fsync_policy='always')
+        first = await spool.append('room1', 'user1', 'hello')
+        second = await spool.append('room1', 'user2', 'hi')
+        self.assertEqual(spool.depth, 2)
+        self.assertLess(first['seq'], second['seq'])
+        self.assertEqual(spool.pending(1), [first])
+
+        await spool.mark_flushed(first['seq'])
+        self.assertEqual(spool.pending(), [second])
+
+        await spool.mark_flushed(second['seq'])
+        self.assertEqual(spool.depth, 0)
+        self.assertEqual(spool.lag(), 0.0)
+        spool.close()
+
+    async def test_replay_after_crash(self):
+        spool = MessageSpool(self.path, fsync_policy='never')
+        first = await spool.append('room1', 'user1', 'one')
+        await spool.append('room1', 'user1', 'two')
+        await spool.mark_flushed(first['seq'])
+        await spool.append('room2', 'user1', 'three')
+        spool.close()
+
+        # simulate a write torn by a crash
+        with open(self.path, 'a') as file:
+            file.write('{"seq": 4, "ts"')
+
+        spool = MessageSpool(self.path, fsync_policy='never')
+        self.assertEqual([e['content'] for e in spool.pending()],
+                         ['two', 'three'])
+
+        # new messages continue the sequence after the torn line
+        entry = await spool.append('room1', 'user1', 'four')
+        self.assertEqual(entry['seq'], 4)
+        spool.close()
+
+        spool = MessageSpool(self.path, fsync_policy='never')
+        self.assertEqual(spool.depth, 3)
+        spool.close()
+
+    async def test_sequence_survives_truncation(self):
+        spool = MessageSpool(self.path)
+        entry = await spool.append('room1', 'user1', 'hello')
+        await spool.mark_flushed(entry['seq'])
+        spool.close()
+
+        spool = MessageSpool(self.path)
+        self.assertEqual(spool.depth, 0)
+        self.assertGreater((await spool.append('room1', 'user1', 'again'))['seq'],
+                           entry['seq'])
+        spool.close()
+
+    async def test_epoch(self):
+        spool = MessageSpool(self.path)
+        epoch = spool.epoch
+        spool.close()
+
+        # the epoch is kept when the spool is reopened...
+        spool = MessageSpool(self.path)
+        self.assertEqual(spool.epoch, epoch)
+        spool.close()
+
+        # ...and a lost spool gets a new one, so (epoch, seq) stays unique
+        os.remove(self.path)
+        os.remove(self.path + '.checkpoint')
+        spool = MessageSpool(self.path)
+        self.assertNotEqual(spool.epoch, epoch)
+        self.assertEqual((await spool.append('room1', 'user1', 'hello'))['seq'], 1)
+        spool.close()
+
+    async def test_always_syncs_before_returning(self):
+        spool = MessageSpool(self.path, fsync_policy='always')
+        entries = await asyncio.gather(*(spool.append('room1', 'user1', str(i))
+                                         for i in range(10)))
+        self.assertEqual(spool.synced_seq, entries[-1]['seq'])
+        spool.close()
+
+    async def test_interval_syncs_when_traffic_stops(self):
+        spool = MessageSpool(self.path, fsync_policy='interval', fsync_interval=0.05)
+        entry = await spool.append('room1', 'user1', 'hello')
+        self.assertLess(spool.synced_seq, entry['seq'])
+
+        # no new messages, the periodic call alone has to sync it
+        await spool.sync_if_due()
+        self.assertLess(spool.synced_seq, entry['seq'])
+        time.sleep(0.06)
+        await spool.sync_if_due()
+        self.assertEqual(spool.synced_seq, entry['seq'])
+        spool.close()
+
+    def test_unknown_fsync_policy(self):
+        with self.assertRaises(ValueError):
+            MessageSpool(self.path, fsync_policy='sometimes')
+
+
+class CheckMessageTest(unittest.TestCase):
+
+    def test_valid(self):
+        check_message('room', 'user', 'hello', 'chat-1,room,')
+
+    def test_rejects_what_the_database_would(self):
+        for chatroom_id, content in [('room', 'a\x00b'),
+                                     ('r' * 256, 'hello'),
+                                     ('room', b'bytes'),
+                                     ('room', 'é' * 4000)]:
+            with self.assertRaises(ValueError):
+                check_message(chatroom_id, 'user', content, f'chat-1,{chatroom_id},')
+
+    def test_notify_prefix_counts(self):
+        content = 'a' * 7990
+        check_message('room', 'user', content)
+        with self.assertRaises(ValueError):
+            check_message('room', 'user', content, 'chat-1,room,')
+
+
+if __name__ == '__main__':
+    unittest.main()
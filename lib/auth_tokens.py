@@ -0,0 +1,16 @@
+'''Bearer tokens from the app config, for the admin and debug endpoints.'''
+import hmac
+
+from quart import current_app, request
+
+
+def check_bearer_token(config_key):
+    '''Check that the request has `Authorization: Bearer <token>`
+    with the token in config_key. False if it isn't set.'''
+    expected = current_app.config.get(config_key)
+    auth_header = request.headers.get('Authorization', '').split()
+    if not expected or len(auth_header) != 2 or auth_header[0].lower() != 'bearer':
+        return False
+    # from_prefixed_env parses values as JSON, so a numeric token is an int,
+    # and compare_digest only takes ASCII strings, but any bytes
+    return hmac.compare_digest(auth_header[1].encode(), str(expected).encode())
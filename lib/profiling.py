@@ -0,0 +1,147 @@
+'''Debug endpoints for looking into a running service.
+
+GET /debug/profile samples the event loop thread's stack for a few seconds
+and returns it in the folded format of flamegraph.pl and speedscope.
+GET /debug/tasks lists the running asyncio tasks with their ages,
+and the chain of coroutines each one is awaiting.
+
+Both are disabled unless QUART_DEBUG_TOKEN is set,
+and expect it as a bearer token.
+'''
+import asyncio
+from collections import Counter
+import math
+import os
+import sys
+import threading
+import time
+import weakref
+
+from quart import Blueprint, abort, current_app, jsonify, request, Response
+from quart_rate_limiter import rate_exempt
+
+from auth_tokens import check_bearer_token
+
+
+# limits of the profile duration and sampling interval, in seconds
+PROFILE_MAX_DURATION = 60.0
+PROFILE_MIN_INTERVAL = 0.001
+
+# number of coroutines shown per task, from the task's own inward
+TASK_STACK_LIMIT = 10
+
+
+debug = Blueprint('debug', __name__)
+
+_profile_lock = asyncio.Lock()
+_task_created = weakref.WeakKeyDictionary()
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(thread_id, duration, interval):
+    '''Sample the stack of a thread every interval seconds for duration seconds.
+    Return the number of times each stack was seen, outermost frame first.'''
+    counts = Counter()
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+        if stack:
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+
+def track_task_ages(loop):
+    '''Record when each task of the loop is created, for dump_tasks.'''
+    previous_factory = loop.get_task_factory()
+
+    def factory(loop, coro, **kwargs):
+        if previous_factory is None:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        else:
+            task = previous_factory(loop, coro, **kwargs)
+        _task_created[task] = time.monotonic()
+        return task
+
+    loop.set_task_factory(factory)
+
+
+def await_chain(coro, limit=TASK_STACK_LIMIT):
+    '''Describe the coroutine and the ones it is awaiting, outermost first,
+    with the line each is suspended at.'''
+    stack = []
+    while coro is not None and len(stack) < limit:
+        frame = (getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+                 or getattr(coro, 'ag_frame', None))
+        # a future, or a coroutine that has finished
+        if frame is None:
+            break
+        stack.append(f"{_frame_name(frame)} line {frame.f_lineno}")
+        coro = (getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+                or getattr(coro, 'ag_await', None))
+    return stack
+
+
+def dump_tasks():
+    '''Describe the running tasks, oldest first.
+    The age is None for tasks created before track_task_ages.'''
+    now = time.monotonic()
+    tasks = []
+    for task in asyncio.all_tasks():
+        created = _task_created.get(task)
+        tasks.append({
+            'name': task.get_name(),
+            'coro': getattr(task.get_coro(), '__qualname__', repr(task.get_coro())),
+            'age_seconds': None if created is None else round(now - created, 3),
+            'stack': await_chain(task.get_coro()),
+        })
+    tasks.sort(key=lambda t: -1 if t['age_seconds'] is None else -t['age_seconds'])
+    return tasks
+
+
+@debug.before_request
+async def check_debug_token():
+    if not current_app.config.get('DEBUG_TOKEN'):
+        abort(404)
+    if not check_bearer_token('DEBUG_TOKEN'):
+        abort(403)
+
+
+@debug.get('/debug/profile')
+@rate_exempt
+async def profile_view():
+    '''Sample the event loop for `seconds` (default 10),
+    every `interval_ms` milliseconds (default 10).'''
+    try:
+        duration = float(request.args.get('seconds', 10))
+        interval = float(request.args.get('interval_ms', 10)) / 1000
+    except ValueError:
+        return jsonify({"error": "Invalid parameters"}), 400
+    if not (math.isfinite(duration) and math.isfinite(interval)):
+        return jsonify({"error": "Invalid parameters"}), 400
+    duration = max(0.0, min(duration, PROFILE_MAX_DURATION))
+    interval = max(interval, PROFILE_MIN_INTERVAL)
+
+    if _profile_lock.locked():
+        return jsonify({"error": "A profile is already running"}), 409
+    async with _profile_lock:
+        # sample from another thread, so that the loop keeps serving
+        counts = await asyncio.to_thread(
+            sample_stacks, threading.get_ident(), duration, interval)
+
+    folded = ''.join(f"{stack} {count}\n" for stack, count in counts.most_common())
+    return Response(folded, content_type='text/plain')
+
+
+@debug.get('/debug/tasks')
+@rate_exempt
+async def tasks_view():
+    return jsonify({"tasks": dump_tasks()})
@@ -0,0 +1,36 @@
+from auth_tokens import check_bearer_token
+
+import unittest
+
+from quart import Quart
+
+
+class CheckBearerTokenTest(unittest.IsolatedAsyncioTestCase):
+    async def check(self, token, header):
+        app = Quart(__name__)
+        if token is not None:
+            app.config['ADMIN_TOKEN'] = token
+        headers = {} if header is None else {'Authorization': header}
+        async with app.test_request_context('/', headers=headers):
+            return check_bearer_token('ADMIN_TOKEN')
+
+    async def test_valid(self):
+        self.assertTrue(await self.check('secret', 'Bearer secret'))
+        self.assertTrue(await self.check('secret', 'bearer secret'))
+
+    async def test_numeric_token(self):
+        # QUART_ADMIN_TOKEN=123456 is parsed as an int by from_prefixed_env
+        self.assertTrue(await self.check(123456, 'Bearer 123456'))
+
+    async def test_unset(self):
+        self.assertFalse(await self.check(None, 'Bearer secret'))
+        self.assertFalse(await self.check('', 'Bearer '))
+
+    async def test_invalid(self):
+        for header in [None, 'Bearer', 'Bearer nope', 'Basic secret',
+                       'Bearer secret extra', 'Bearer \xff']:
+            self.assertFalse(await self.check('secret', header), header)
+
+
+if __name__ == '__main__':
+    unittest.main()
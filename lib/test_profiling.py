@@ -0,0 +1,140 @@
+from profiling import debug, sample_stacks, track_task_ages, dump_tasks
+
+import asyncio
+import threading
+import time
+import unittest
+
+from quart import Quart
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class SampleStacksTest(unittest.TestCase):
+    def test_samples_thread(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=busy_loop, args=(stop,))
+        thread.start()
+        try:
+            counts = sample_stacks(thread.ident, 0.1, 0.005)
+        finally:
+            stop.set()
+            thread.join()
+
+        self.assertGreater(sum(counts.values()), 5)
+        stack, _ = counts.most_common(1)[0]
+        # outermost frame first, innermost last
+        self.assertTrue(stack.split(';')[-1].startswith('busy_loop ('))
+
+    def test_unknown_thread(self):
+        counts = sample_stacks(-1, 0.01, 0.005)
+        self.assertEqual(counts, {})
+
+
+class DumpTasksTest(unittest.IsolatedAsyncioTestCase):
+    async def test_ages(self):
+        track_task_ages(asyncio.get_running_loop())
+
+        async def sleeper():
+            await asyncio.sleep(10)
+
+        old = asyncio.create_task(sleeper(), name='old')
+        await asyncio.sleep(0.05)
+        new = asyncio.create_task(sleeper(), name='new')
+        await asyncio.sleep(0)
+        try:
+            tasks = {t['name']: t for t in dump_tasks()}
+        finally:
+            old.cancel()
+            new.cancel()
+
+        self.assertEqual(tasks['old']['coro'], 'DumpTasksTest.test_ages.<locals>.sleeper')
+        self.assertGreaterEqual(tasks['old']['age_seconds'], 0.05)
+        self.assertLess(tasks['new']['age_seconds'], tasks['old']['age_seconds'])
+        self.assertTrue(any(frame.startswith('sleeper (') for frame in tasks['old']['stack']))
+
+        names = [t['name'] for t in dump_tasks()]
+        self.assertLess(names.index('old'), names.index('new'))
+
+    async def test_await_chain(self):
+        async def inner():
+            await asyncio.sleep(10)
+
+        async def middle():
+            await inner()
+
+        async def outer():
+            await middle()
+
+        task = asyncio.create_task(outer(), name='nested')
+        await asyncio.sleep(0)
+        try:
+            tasks = {t['name']: t for t in dump_tasks()}
+        finally:
+            task.cancel()
+
+        stack = tasks['nested']['stack']
+        self.assertEqual([frame.split(' (')[0] for frame in stack],
+                         ['outer', 'middle', 'inner', 'sleep'])
+        # the line each coroutine is suspended at, not where it starts
+        line = inner.__code__.co_firstlineno + 1
+        self.assertTrue(stack[2].endswith(f' line {line}'))
+
+
+class DebugTokenTest(unittest.IsolatedAsyncioTestCase):
+    def make_client(self, token):
+        app = Quart(__name__)
+        if token is not None:
+            app.config['DEBUG_TOKEN'] = token
+        app.register_blueprint(debug)
+        return app.test_client()
+
+    async def test_disabled_without_token(self):
+        response = await self.make_client(None).get('/debug/tasks')
+        self.assertEqual(response.status_code, 404)
+
+    async def test_wrong_token(self):
+        response = await self.make_client('secret').get(
+            '/debug/tasks', headers={'Authorization': 'Bearer nope'})
+        self.assertEqual(response.status_code, 403)
+
+    async def test_bearer_scheme_required(self):
+        response = await self.make_client('secret').get(
+            '/debug/tasks', headers={'Authorization': 'Basic secret'})
+        self.assertEqual(response.status_code, 403)
+
+    async def test_non_ascii_token(self):
+        response = await self.make_client('secret').get(
+            '/debug/tasks', headers={'Authorization': 'Bearer \xff'})
+        self.assertEqual(response.status_code, 403)
+
+    async def test_numeric_token(self):
+        # QUART_DEBUG_TOKEN=123456 is parsed as an int by from_prefixed_env
+        client = self.make_client(123456)
+        response = await client.get('/debug/tasks',
+                                    headers={'Authorization': 'Bearer 123456'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('tasks', await response.get_json())
+
+    async def test_profile(self):
+        client = self.make_client('secret')
+        response = await client.get('/debug/profile?seconds=0.05&interval_ms=5',
+                                    headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+        lines = (await response.get_data(as_text=True)).splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in lines))
+
+    async def test_profile_rejects_nan(self):
+        client = self.make_client('secret')
+        for query in ['seconds=nan', 'interval_ms=nan', 'seconds=inf']:
+            response = await client.get('/debug/profile?' + query,
+                                        headers={'Authorization': 'Bearer secret'})
+            self.assertEqual(response.status_code, 400, query)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+from tracing import span, init_slow_request_log, _trace
+
+import asyncio
+import contextlib
+import io
+import json
+import unittest
+
+from quart import Quart
+
+
+def make_app(threshold):
+    app = Quart(__name__)
+    init_slow_request_log(app, threshold)
+
+    @app.route('/ok')
+    async def ok():
+        with span('db'):
+            await asyncio.sleep(0.01)
+        return 'ok'
+
+    @app.route('/fail')
+    async def fail():
+        with span('redis'):
+            await asyncio.sleep(0.01)
+        raise RuntimeError('boom')
+
+    return app
+
+
+async def get_logs(app, path):
+    '''Request the path and return the slow request log entries.'''
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        response = await app.test_client().get(path)
+    entries = [json.loads(line.split(': ', 1)[1])
+               for line in out.getvalue().splitlines()
+               if line.startswith('Slow request: ')]
+    return response, entries
+
+
+class SpanTest(unittest.TestCase):
+    def test_noop_without_trace(self):
+        self.assertIs(span('db'), span('redis'))
+        with span('db'):
+            pass
+
+    def test_records_in_trace(self):
+        trace = []
+        token = _trace.set(trace)
+        try:
+            with span('db'):
+                pass
+            with self.assertRaises(ValueError):
+                with span('hashing'):
+                    raise ValueError()
+        finally:
+            _trace.reset(token)
+        self.assertEqual([name for name, _, _ in trace], ['db', 'hashing'])
+        self.assertTrue(all(duration >= 0 for _, _, duration in trace))
+
+
+class SlowRequestLogTest(unittest.IsolatedAsyncioTestCase):
+    async def test_logs_slow_request(self):
+        response, entries = await get_logs(make_app(0.005), '/ok')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['path'], '/ok')
+        self.assertEqual(entries[0]['status'], 200)
+        self.assertEqual([s['name'] for s in entries[0]['spans']], ['db'])
+
+    async def test_skips_fast_request(self):
+        _, entries = await get_logs(make_app(10.0), '/ok')
+        self.assertEqual(entries, [])
+
+    async def test_logs_failing_request(self):
+        response, entries = await get_logs(make_app(0.005), '/fail')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['status'], 500)
+        self.assertIn('boom', entries[0]['error'])
+        self.assertEqual([s['name'] for s in entries[0]['spans']], ['redis'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+'''Per-request spans, logged for requests slower than a threshold.
+
+Wrap the interesting parts of a request in `with span('db'):`.
+Unless init_slow_request_log was called for the app, span returns
+a shared no-op context manager, so the instrumentation costs next to nothing.
+'''
+from contextlib import contextmanager, nullcontext
+import contextvars
+import json
+import time
+
+from quart import g, got_request_exception, request
+
+
+_trace = contextvars.ContextVar('trace', default=None)
+_noop = nullcontext()
+
+
+def span(name):
+    '''Context manager recording how long its block took in the current request.'''
+    trace = _trace.get()
+    if trace is None:
+        return _noop
+    return _span(trace, name)
+
+
+@contextmanager
+def _span(trace, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.append((name, start, time.perf_counter() - start))
+
+
+def init_slow_request_log(app, threshold):
+    '''Log the spans of every request taking more than threshold seconds,
+    including the ones failing with an exception.'''
+
+    @app.before_request
+    async def start_trace():
+        g.trace_start = time.perf_counter()
+        g.trace = []
+        _trace.set(g.trace)
+
+    @app.after_request
+    async def record_status(response):
+        g.trace_status = response.status_code
+        return response
+
+    # a view raising is turned into a 500 response before the teardown,
+    # so the exception is recorded as it happens
+    async def record_exception(sender, exception, **extra):
+        g.trace_error = repr(exception)
+
+    got_request_exception.connect(record_exception, app, weak=False)
+
+    @app.teardown_request
+    async def log_slow_request(exc):
+        start = g.get('trace_start')
+        if start is None:
+            return
+        duration = time.perf_counter() - start
+        if duration < threshold:
+            return
+        entry = {
+            'method': request.method,
+            'path': request.path,
+            'status': g.get('trace_status', 500),
+            'duration_ms': round(duration * 1000, 3),
+            'spans': [{'name': name,
+                       'start_ms': round((span_start - start) * 1000, 3),
+                       'duration_ms': round(span_duration * 1000, 3)}
+                      for name, span_start, span_duration in g.trace],
+        }
+        error = repr(exc) if exc is not None else g.get('trace_error')
+        if error is not None:
+            entry['error'] = error
+        print("Slow request: " + json.dumps(entry))
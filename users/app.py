@@ -7,15 +7,20 @@ import grpc
 import click
 import psycopg
 from quart import Quart, request, jsonify, Response
-from quart_rate_limiter import RateLimiter, RateLimit
+from quart_rate_limiter import RateLimiter, RateLimit, rate_exempt
 from prometheus_client import generate_latest, Counter, Summary, CONTENT_TYPE_LATEST
 
 import registry_pb2
 import registry_pb2_grpc
 from db import get_db
 from prometheus_utils import inc_counter
+from profiling import debug, track_task_ages
+from tracing import init_slow_request_log
+from auth_tokens import check_bearer_token
 
-from auth import register, create_session, logout, verify_token, delete_user
+from auth import (register, create_session, logout, verify_token, delete_user,
+                  bulk_register, shutdown_hash_pool)
+from importing import iter_import_rows
 
 
 # Service discovery
@@ -23,6 +28,9 @@ hostname = os.getenv('HOSTNAME', '0.0.0.0')
 service_name = os.getenv('SERVICE_NAME')
 port = int(os.getenv('PORT', 5000))
 
+# log the spans of requests slower than this, off when unset
+SLOW_REQUEST_THRESHOLD_MS = os.getenv('SLOW_REQUEST_THRESHOLD_MS')
+
 
 app = Quart(__name__)
 SECRET_KEY = "your_secret_key"
@@ -35,10 +43,17 @@ rate_limiter = RateLimiter(app, default_limits=[
     RateLimit(3, timedelta(seconds=10))
 ])
 
+# /debug endpoints, enabled by QUART_DEBUG_TOKEN
+app.register_blueprint(debug)
+if SLOW_REQUEST_THRESHOLD_MS:
+    init_slow_request_log(app, float(SLOW_REQUEST_THRESHOLD_MS) / 1000)
+
 
 # Prometheus counter
 req_counter = Counter('request_count', 'Number of HTTP requests handled')
 req_time = Summary('request_latency_seconds', 'Request latency')
+# imports take much longer than other requests, so they are kept apart
+import_time = Summary('user_import_seconds', 'Bulk user import duration')
 
 
 async def _init_db():
@@ -133,6 +148,37 @@ async def verify_view():
     return jsonify({"message": "Token is valid"}), 200
 
 
+def is_admin() -> bool:
+    '''Check the bearer token against QUART_ADMIN_TOKEN.
+    Admin endpoints are disabled when it isn't set.'''
+    return check_bearer_token('ADMIN_TOKEN')
+
+
+@app.route('/admin/users/import', methods=['POST'])
+@rate_exempt
+@inc_counter(req_counter)
+@import_time.time()
+async def import_users_view():
+    '''Register users in bulk from a JSON-lines or CSV body.
+    MAX_CONTENT_LENGTH only limits the declared length, so bodies larger
+    than it are sent chunked, and importing.MAX_IMPORT_BYTES limits them.
+    The body is parsed as it arrives, but while a batch is hashed
+    Quart keeps buffering it, up to MAX_CONTENT_LENGTH.'''
+    if not is_admin():
+        return jsonify({"error": "Forbidden"}), 403
+
+    is_csv = request.mimetype == 'text/csv'
+    invalid = []
+    result = await bulk_register(iter_import_rows(request.body, is_csv, invalid))
+
+    return jsonify({
+        "created": result["created"],
+        "conflicts": [{"line": line, "username": username}
+                      for line, username in result["conflicts"]],
+        "invalid": [{"line": line} for line in invalid],
+    }), 200
+
+
 async def register_service(service_name, address):
 
     async def send_info():
@@ -170,6 +216,11 @@ def task_done_callback(task):
         traceback.print_exc()
 
 
+@app.before_serving
+async def startup_task_tracking():
+    track_task_ages(asyncio.get_running_loop())
+
+
 @app.before_serving
 async def startup_RPC_task():
     loop = asyncio.get_event_loop()
@@ -184,6 +235,11 @@ async def shutdown_RPC_task():
     app.register_task.cancel()
 
 
+@app.after_serving
+async def shutdown_hash_workers():
+    shutdown_hash_pool()
+
+
 @app.before_serving
 async def startup():
     # either init db from here,
@@ -1,24 +1,39 @@
+import asyncio
 import uuid
 import datetime
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 
 import psycopg
 
 from db import get_db
-from hashing import check_password, hash_password
+from hashing import check_password, hash_password, hash_password_batch
+from importing import find_conflicts
+from tracing import span
+
+
+# number of users hashed and copied into the database per transaction
+IMPORT_BATCH_SIZE = 1000
+
+# PBKDF2 is CPU-bound, so bulk imports hash in worker processes
+_hash_pool = None
 
 
 async def register(username, password) -> None:
     '''Try to register. Raise ValueError if username exists.'''
-    salt, password_hash = hash_password(password)
+    with span('hashing'):
+        salt, password_hash = hash_password(password)
 
     conn = await get_db()
     async with conn.cursor() as cur:
         try:
-            await cur.execute(
-                'INSERT INTO users (username, password_hash, salt) VALUES (%s, %s, %s)',
-                (username, password_hash, salt)
-            )
-            await conn.commit()
+            with span('db'):
+                await cur.execute(
+                    'INSERT INTO users (username, password_hash, salt) VALUES (%s, %s, %s)',
+                    (username, password_hash, salt)
+                )
+                await conn.commit()
 
         except psycopg.errors.UniqueViolation:
             raise ValueError("Username exists")
@@ -28,43 +43,49 @@ async def create_session(username, password) -> str:
     '''If credentials are correct, create a session token, store it and return it.'''
     conn = await get_db()
     async with conn.cursor() as cur:
-        await cur.execute(
-            'SELECT id, password_hash, salt FROM users WHERE username=%s', (
-                username,)
-        )
-        user = await cur.fetchone()
+        with span('db'):
+            await cur.execute(
+                'SELECT id, password_hash, salt FROM users WHERE username=%s', (
+                    username,)
+            )
+            user = await cur.fetchone()
 
         if not user:
             raise ValueError("Invalid username")
 
         id, password_hash, salt = user
-        if not check_password(salt, password_hash, password):
+        with span('hashing'):
+            password_ok = check_password(salt, password_hash, password)
+        if not password_ok:
             raise ValueError("Incorret password")
 
         # Generate a bearer token
         token = str(uuid.uuid4())
         expiration = datetime.datetime.utcnow() + datetime.timedelta(days=1)
-        await cur.execute(
-            'INSERT INTO sessions (user_id, token, expires_at) VALUES (%s, %s, %s)',
-            (user[0], token, expiration)
-        )
-        await conn.commit()
+        with span('db'):
+            await cur.execute(
+                'INSERT INTO sessions (user_id, token, expires_at) VALUES (%s, %s, %s)',
+                (user[0], token, expiration)
+            )
+            await conn.commit()
         return token
 
 
 async def logout(token: str):
     conn = await get_db()
     async with conn.cursor() as cur:
-        await cur.execute('DELETE FROM sessions WHERE token=%s', (token,))
-        await conn.commit()
+        with span('db'):
+            await cur.execute('DELETE FROM sessions WHERE token=%s', (token,))
+            await conn.commit()
 
 
 async def verify_token(token: str) -> bool:
     conn = await get_db()
     async with conn.cursor() as cur:
-        await cur.execute(
-            "SELECT EXISTS(SELECT 1 FROM sessions WHERE token = %s)", (token,))
-        exists = (await cur.fetchone())[0]
+        with span('db'):
+            await cur.execute(
+                "SELECT EXISTS(SELECT 1 FROM sessions WHERE token = %s)", (token,))
+            exists = (await cur.fetchone())[0]
         return exists
 
 
@@ -72,10 +93,101 @@ async def delete_user(username: str):
     conn = await get_db()
     async with conn.cursor() as cur:
         try:
-            await cur.execute(
-                "DELETE FROM users WHERE username = %s", (username,)
-            )
-            await conn.commit()
+            with span('db'):
+                await cur.execute(
+                    "DELETE FROM users WHERE username = %s", (username,)
+                )
+                await conn.commit()
 
         except psycopg.errors.UniqueViolation:
             raise ValueError("Couldn't delete user")
+
+
+def _get_hash_pool() -> ProcessPoolExecutor:
+    global _hash_pool
+    if _hash_pool is None:
+        # forking the running server would copy its event loop and gRPC state,
+        # which doesn't survive a fork, so workers come from a forkserver
+        _hash_pool = ProcessPoolExecutor(
+            mp_context=multiprocessing.get_context('forkserver'))
+    return _hash_pool
+
+
+def shutdown_hash_pool() -> None:
+    global _hash_pool
+    if _hash_pool is not None:
+        _hash_pool.shutdown(cancel_futures=True)
+        _hash_pool = None
+
+
+async def _hash_batch(passwords: list) -> list:
+    '''Hash the passwords in parallel, one chunk per CPU core.'''
+    loop = asyncio.get_running_loop()
+    pool = _get_hash_pool()
+    n_chunks = os.cpu_count() or 1
+    size = max(1, -(-len(passwords) // n_chunks))
+    chunks = [passwords[i:i + size] for i in range(0, len(passwords), size)]
+    results = await asyncio.gather(*(
+        loop.run_in_executor(pool, hash_password_batch, chunk) for chunk in chunks
+    ))
+    return [hashed for chunk in results for hashed in chunk]
+
+
+async def _copy_batch(batch: list, hashes: list) -> set:
+    '''COPY a batch into a staging table and move it into users,
+    skipping existing usernames. Return the set of inserted usernames.'''
+    conn = await get_db()
+    async with conn.cursor() as cur:
+        await cur.execute(
+            'CREATE TEMP TABLE users_import ('
+            'line INTEGER, username VARCHAR(50), password_hash BYTEA, salt BYTEA'
+            ') ON COMMIT DROP'
+        )
+        async with cur.copy(
+            'COPY users_import (line, username, password_hash, salt) FROM STDIN'
+        ) as copy:
+            for (line, username, _), (salt, password_hash) in zip(batch, hashes):
+                await copy.write_row((line, username, password_hash, salt))
+
+        await cur.execute(
+            'INSERT INTO users (username, password_hash, salt) '
+            'SELECT username, password_hash, salt FROM users_import ORDER BY line '
+            'ON CONFLICT (username) DO NOTHING RETURNING username'
+        )
+        inserted = {row[0] for row in await cur.fetchall()}
+        await conn.commit()
+    return inserted
+
+
+async def _import_batch(batch: list) -> list:
+    '''Import one batch of (line, username, password) rows.
+    Return the line numbers and usernames that conflicted.'''
+    with span('hashing'):
+        hashes = await _hash_batch([password for _, _, password in batch])
+    with span('db'):
+        inserted = await _copy_batch(batch, hashes)
+    return find_conflicts(batch, inserted)
+
+
+async def bulk_register(rows) -> dict:
+    '''Register users from an async iterable of (line, username, password)
+    rows in batches. Existing usernames are reported as conflicts.'''
+    created = 0
+    conflicts = []
+    batch = []
+
+    async def flush():
+        nonlocal created
+        batch_conflicts = await _import_batch(batch)
+        created += len(batch) - len(batch_conflicts)
+        conflicts.extend(batch_conflicts)
+        batch.clear()
+
+    async for row in rows:
+        batch.append(row)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await flush()
+    if batch:
+        await flush()
+
+    return {"created": created, "conflicts": conflicts}
@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import List, Tuple
 import os
 import hashlib
 import hmac
@@ -23,3 +23,11 @@ def check_password(salt: bytes, pw_hash: bytes, password: str) -> bool:
         pw_hash,
         hashlib.pbkdf2_hmac('sha256', password.encode(), salt, 100000)
     )
+
+
+def hash_password_batch(passwords: List[str]) -> List[Tuple[bytes, bytes]]:
+    """
+    Hash several passwords in a row. Meant to be submitted to a process pool,
+    so that one task amortizes the pickling overhead over many hashes.
+    """
+    return [hash_password(password) for password in passwords]
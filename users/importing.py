@@ -0,0 +1,156 @@
+import csv
+import json
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+
+# the length of users.username
+MAX_USERNAME_LENGTH = 50
+
+# longest CSV record, in characters, to stop waiting for an unclosed quote
+MAX_RECORD_LENGTH = 65536
+
+# longest line, in bytes, kept in memory until its newline arrives
+MAX_LINE_LENGTH = 65536
+
+# largest import body, in bytes
+MAX_IMPORT_BYTES = 100 * 1024 * 1024
+
+
+async def iter_lines(chunks, max_line_length=MAX_LINE_LENGTH, max_bytes=MAX_IMPORT_BYTES):
+    '''Yield the lines of a stream of byte chunks as they arrive.
+    Lines longer than max_line_length are yielded as None, without
+    keeping them in memory. Raise RequestEntityTooLarge past max_bytes.'''
+    total = 0
+    # the pieces of the current line, and their length (None once too long)
+    parts = []
+    length = 0
+    async for chunk in chunks:
+        total += len(chunk)
+        if total > max_bytes:
+            raise RequestEntityTooLarge(f"Imports are limited to {max_bytes} bytes")
+        # only the new chunk is split, the pieces are joined once per line
+        *lines, rest = chunk.split(b'\n')
+        for line in lines:
+            if length is None or length + len(line) > max_line_length:
+                yield None
+            else:
+                parts.append(line)
+                yield b''.join(parts)
+            parts = []
+            length = 0
+        if length is not None:
+            length += len(rest)
+            if length > max_line_length:
+                parts = []
+                length = None
+            else:
+                parts.append(rest)
+    if length is None:
+        yield None
+    elif length:
+        yield b''.join(parts)
+
+
+async def iter_records(lines, is_csv):
+    '''Group the lines into (line number, text) records.
+    A CSV record spans several lines when a quoted field contains newlines.
+    The text is None when the record is too long or isn't valid UTF-8.'''
+    line_no = 0
+    record = None
+    first_line_no = 0
+    async for line in lines:
+        line_no += 1
+        try:
+            text = None if line is None else line.decode().rstrip('\r')
+        except UnicodeDecodeError:
+            text = None
+        if text is None:
+            if record is not None:
+                yield first_line_no, None
+                record = None
+            else:
+                yield line_no, None
+            continue
+
+        if record is None:
+            record = text
+            first_line_no = line_no
+        else:
+            record += '\n' + text
+
+        # an odd number of quotes means a quoted field is still open
+        if is_csv and record.count('"') % 2 and len(record) < MAX_RECORD_LENGTH:
+            continue
+        yield first_line_no, record
+        record = None
+
+    if record is not None:
+        yield first_line_no, record
+
+
+def parse_record(text, is_csv, header):
+    '''Return the (username, password) of a record,
+    or None if it can't be imported.'''
+    try:
+        if is_csv:
+            data = dict(zip(header, next(csv.reader([text], strict=True))))
+        else:
+            data = json.loads(text)
+    except (ValueError, csv.Error):
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    username = data.get('username')
+    password = data.get('password')
+    if not isinstance(username, str) or not isinstance(password, str):
+        return None
+    if not username or len(username) > MAX_USERNAME_LENGTH or not password:
+        return None
+    # Postgres text can't hold NUL, and lone surrogates from JSON can't be encoded
+    if '\x00' in username:
+        return None
+    try:
+        username.encode()
+        password.encode()
+    except UnicodeEncodeError:
+        return None
+    return username, password
+
+
+async def iter_import_rows(chunks, is_csv, invalid):
+    '''Parse a streamed JSON-lines or CSV body into (line, username, password)
+    rows. The line numbers of records that can't be imported are appended
+    to `invalid`. CSV bodies start with a header naming the columns.'''
+    header = None
+    async for line_no, text in iter_records(iter_lines(chunks), is_csv):
+        if text is not None and not text.strip():
+            continue
+        if is_csv and header is None and text is not None:
+            try:
+                header = next(csv.reader([text], strict=True))
+            except csv.Error:
+                invalid.append(line_no)
+            continue
+
+        row = None if text is None else parse_record(text, is_csv, header)
+        if row is None:
+            invalid.append(line_no)
+            continue
+        yield (line_no,) + row
+
+
+def find_conflicts(batch, inserted):
+    '''Given a batch of (line, username, password) rows and the set of
+    usernames inserted from it, return the (line, username) rows which
+    weren't imported. A username repeated within the batch is only
+    inserted for its first line.'''
+    inserted = set(inserted)
+    conflicts = []
+    for line, username, _ in batch:
+        if username in inserted:
+            inserted.discard(username)
+        else:
+            conflicts.append((line, username))
+    return conflicts
@@ -0,0 +1,110 @@
+from importing import iter_import_rows, iter_lines, find_conflicts, MAX_LINE_LENGTH
+
+import asyncio
+import unittest
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+
+async def _chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def parse(*chunks, is_csv=False):
+    '''Return the rows and the invalid line numbers of a body.'''
+    invalid = []
+
+    async def collect():
+        return [row async for row in iter_import_rows(_chunks(*chunks), is_csv, invalid)]
+
+    return asyncio.run(collect()), invalid
+
+
+def lines(*chunks, **limits):
+    async def collect():
+        return [line async for line in iter_lines(_chunks(*chunks), **limits)]
+
+    return asyncio.run(collect())
+
+
+class IterLinesTest(unittest.TestCase):
+    def test_lines_across_chunks(self):
+        self.assertEqual(lines(b'ab', b'c\nd', b'', b'\n\nef'),
+                         [b'abc', b'd', b'', b'ef'])
+
+    def test_long_lines(self):
+        self.assertEqual(lines(b'abcd\nabcde', b'f\nab\nabcdefgh', max_line_length=4),
+                         [b'abcd', None, b'ab', None])
+
+    def test_byte_limit(self):
+        self.assertEqual(lines(b'ab\n', b'cd', max_bytes=5), [b'ab', b'cd'])
+        with self.assertRaises(RequestEntityTooLarge):
+            lines(b'ab\n', b'cd', b'e', max_bytes=5)
+
+
+class ParseJSONLinesTest(unittest.TestCase):
+    def test_rows_split_across_chunks(self):
+        rows, invalid = parse(b'{"username": "alice", "pass',
+                              b'word": "a"}\n\n{"username": "bob", "password": "b"}')
+        self.assertEqual(rows, [(1, 'alice', 'a'), (3, 'bob', 'b')])
+        self.assertEqual(invalid, [])
+
+    def test_invalid_rows(self):
+        body = b'\n'.join([
+            b'{"username": 5, "password": "x"}',
+            b'{"username": "alice", "password": 5}',
+            b'["alice", "x"]',
+            b'{"username": "alice"}',
+            b'not json',
+            b'{"username": "' + b'a' * 51 + b'", "password": "x"}',
+            b'{"username": "al\\u0000ice", "password": "x"}',
+            b'{"username": "alice", "password": "\\ud800"}',
+            b'{"username": "\xff", "password": "x"}',
+            b'{"username": "alice", "password": "x"}',
+        ])
+        rows, invalid = parse(body)
+        self.assertEqual(rows, [(10, 'alice', 'x')])
+        self.assertEqual(invalid, list(range(1, 10)))
+
+    def test_long_line(self):
+        password = 'x' * MAX_LINE_LENGTH
+        rows, invalid = parse(b'{"username": "alice", "password": "',
+                              password.encode(), b'"}\n{"username": "bob", "password": "b"}')
+        self.assertEqual(rows, [(2, 'bob', 'b')])
+        self.assertEqual(invalid, [1])
+
+
+class ParseCSVTest(unittest.TestCase):
+    def test_rows(self):
+        rows, invalid = parse(b'password,username\r\nx,alice\r\ny,bob\r\n', is_csv=True)
+        self.assertEqual(rows, [(2, 'alice', 'x'), (3, 'bob', 'y')])
+        self.assertEqual(invalid, [])
+
+    def test_quoted_newline(self):
+        rows, invalid = parse(b'username,password\n',
+                              b'alice,"multi\nline"\nbob,y\n', is_csv=True)
+        self.assertEqual(rows, [(2, 'alice', 'multi\nline'), (4, 'bob', 'y')])
+        self.assertEqual(invalid, [])
+
+    def test_invalid_rows(self):
+        rows, invalid = parse(b'username,password\nalice\n\xff,x\nbob,y\ncarol,"x',
+                              is_csv=True)
+        self.assertEqual(rows, [(4, 'bob', 'y')])
+        self.assertEqual(invalid, [2, 3, 5])
+
+
+class FindConflictsTest(unittest.TestCase):
+    def test_conflicts(self):
+        batch = [(1, 'alice', 'a'), (2, 'bob', 'b'), (3, 'alice', 'c'), (4, 'carol', 'd')]
+        self.assertEqual(find_conflicts(batch, {'alice', 'carol'}),
+                         [(2, 'bob'), (3, 'alice')])
+
+    def test_does_not_modify_inserted(self):
+        inserted = {'alice'}
+        find_conflicts([(1, 'alice', 'a')], inserted)
+        self.assertEqual(inserted, {'alice'})
+
+
+if __name__ == '__main__':
+    unittest.main()